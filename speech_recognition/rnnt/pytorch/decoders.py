@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
 from typing import List, Optional, Tuple
 
 import torch
@@ -32,11 +33,22 @@ class ScriptGreedyDecoder(torch.nn.Module):
             no limit.
         cutoff_prob: Skip to next step in search if current highest character
             probability is less than this.
+        use_cuda_graphs: Whether to replay each decoding step on CUDA inputs
+            from a captured CUDA graph, see `CudaGraphStep`. Cannot be used
+            with a joint network compiled with `torch.compile`, which
+            captures CUDA graphs of its own.
+        use_cuda_graph_encoder: Whether to run the encoder on CUDA inputs by
+            replaying CUDA graphs captured per padded input shape, see
+            `CudaGraphEncoder`.
+        dtype: The type the model was prepared for inference in, see
+            `RNNT.prepare_for_inference`. Input features are cast to it.
     """
 
-    def __init__(self, blank_index, model, max_symbols_per_step=30):
+    def __init__(self, blank_index, model, max_symbols_per_step=30,
+                 use_cuda_graphs=False, use_cuda_graph_encoder=False,
+                 dtype=torch.float32):
         super().__init__()
-        assert isinstance(model, torch.jit.ScriptModule)
+        assert isinstance(model, torch.nn.Module)
         # assert not model.training
         self.eval()
         self._model = model
@@ -44,14 +56,27 @@ class ScriptGreedyDecoder(torch.nn.Module):
         self._SOS = -1
         assert max_symbols_per_step > 0
         self._max_symbols_per_step = max_symbols_per_step
+        if use_cuda_graphs:
+            if not CudaGraphStep.is_available():
+                raise ValueError("use_cuda_graphs requires torch.cuda.CUDAGraph")
+            if getattr(model, "joint_compiled", False):
+                raise ValueError(
+                    "use_cuda_graphs cannot be used with a compiled joint network")
+        if use_cuda_graph_encoder and not CudaGraphStep.is_available():
+            raise ValueError(
+                "use_cuda_graph_encoder requires torch.cuda.CUDAGraph")
+        self._use_cuda_graphs = use_cuda_graphs
+        self._use_cuda_graph_encoder = use_cuda_graph_encoder
+        self._dtype = dtype
+        self._graph_step = None
+        self._graph_encoder = None
 
     @torch.jit.export
     def forward(self, x: torch.Tensor, out_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, List[List[int]]]:
         """Returns a list of sentences given an input batch.
 
         Args:
-            x: A tensor of size (batch, channels, features, seq_len)
-                TODO was (seq_len, batch, in_features).
+            x: A tensor of size (batch, seq_len, in_features).
             out_lens: list of int representing the length of each sequence
                 output sequence.
 
@@ -60,12 +85,21 @@ class ScriptGreedyDecoder(torch.nn.Module):
         """
         # Apply optional preprocessing
 
-        logits, logits_lens = self._model.encoder(x, out_lens)
+        x = x.to(self._dtype)
+        if self._use_cuda_graph_encoder and x.is_cuda:
+            if self._graph_encoder is None:
+                self._graph_encoder = CudaGraphEncoder(self._model.encoder)
+            logits, logits_lens = self._graph_encoder(x, out_lens)
+        else:
+            logits, logits_lens = self._model.encoder(x, out_lens)
+        # The encoder's contribution to the joint network does not depend
+        # on the labels, so it is projected once for all decoding steps.
+        enc_proj = self._model.joint.project_encoder(logits)
 
         output: List[List[int]] = []
         for batch_idx in range(logits.size(0)):
-            inseq = logits[batch_idx, :, :].unsqueeze(1)
-            # inseq: TxBxF
+            inseq = enc_proj[batch_idx, :, :].unsqueeze(1)
+            # inseq: TxBxJ
             logitlen = logits_lens[batch_idx]
             sentence = self._greedy_decode(inseq, logitlen)
             output.append(sentence)
@@ -82,11 +116,12 @@ class ScriptGreedyDecoder(torch.nn.Module):
             symbols_added = 0
 
             while not_blank and symbols_added < self._max_symbols_per_step:
-                g, hidden_prime = self._pred_step(
+                logp, hidden_prime = self._step(
+                    f,
                     self._get_last_symb(label),
                     hidden
                 )
-                logp = self._joint_step(f, g, log_normalize=False)[0, :]
+                logp = logp[0, :]
 
                 # get index k, of max prob
                 v, k = logp.max(0)
@@ -101,16 +136,31 @@ class ScriptGreedyDecoder(torch.nn.Module):
 
         return label
 
+    def _step(self, f: torch.Tensor, label: int, hidden: Optional[Tuple[torch.Tensor, torch.Tensor]]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        if self._use_cuda_graphs and f.is_cuda:
+            if self._graph_step is None:
+                self._graph_step = CudaGraphStep(self._model, f, self._blank_id)
+            if label == self._SOS:
+                # The start of sequence is embedded at the blank index,
+                # see `Prediction.fuse_embedding`.
+                label = self._blank_id
+            elif label > self._blank_id:
+                label -= 1
+            return self._graph_step(f, label, hidden)
+
+        g, hidden_prime = self._pred_step(label, hidden)
+        return self._joint_step(f, g, log_normalize=False), hidden_prime
+
     def _pred_step(self, label: int, hidden: Optional[Tuple[torch.Tensor, torch.Tensor]]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         if label == self._SOS:
-            return self._model.prediction(None, hidden)
+            return self._model.prediction.predict_step(None, hidden)
         if label > self._blank_id:
             label -= 1
         label = torch.tensor([[label]], dtype=torch.int64)
-        return self._model.prediction(label, hidden)
+        return self._model.prediction.predict_step(label, hidden)
 
     def _joint_step(self, enc: torch.Tensor, pred: torch.Tensor, log_normalize: bool=False) -> torch.Tensor:
-        logits = self._model.joint(enc, pred)[:, 0, 0, :]
+        logits = self._model.joint.joint_step(enc, pred)[:, 0, :]
         if not log_normalize:
             return logits
 
@@ -120,3 +170,268 @@ class ScriptGreedyDecoder(torch.nn.Module):
 
     def _get_last_symb(self, labels: List[int]) -> int:
         return self._SOS if len(labels) == 0 else labels[-1]
+
+
+class BatchedGreedyDecoder(torch.nn.Module):
+    """A greedy transducer decoder that advances all utterances together.
+
+    Produces the same output as `ScriptGreedyDecoder`, but instead of
+    decoding the utterances of a batch one after another, each utterance
+    keeps its own time index and label count, and every step runs one
+    prediction and joint step for all unfinished utterances at once.
+
+    Args:
+        blank_index: See `ScriptGreedyDecoder`.
+        model: Model to use for prediction.
+        max_symbols_per_step: See `ScriptGreedyDecoder`.
+        dtype: See `ScriptGreedyDecoder`.
+    """
+
+    def __init__(self, blank_index, model, max_symbols_per_step=30,
+                 dtype=torch.float32):
+        super().__init__()
+        self.eval()
+        self._model = model
+        self._blank_id = blank_index
+        assert max_symbols_per_step > 0
+        self._max_symbols_per_step = max_symbols_per_step
+        self._dtype = dtype
+
+    def forward(self, x: torch.Tensor, out_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, List[List[int]]]:
+        """See `ScriptGreedyDecoder.forward`."""
+        logits, logits_lens = self._model.encoder(x.to(self._dtype), out_lens)
+        enc_proj = self._model.joint.project_encoder(logits)
+        return logits, logits_lens, self._greedy_decode(enc_proj, logits_lens)
+
+    def _greedy_decode(self, enc_proj: torch.Tensor, out_lens: torch.Tensor) -> List[List[int]]:
+        B = enc_proj.size(0)
+        device = enc_proj.device
+        out_lens = out_lens.to(device)
+
+        hyps = HypBatch(self._model.pred_rnn_layers, self._model.pred_n_hidden,
+                        B, dtype=self._dtype, device=device)
+        for b, out_len in enumerate(out_lens.tolist()):
+            if out_len > 0:
+                hyps.add(b)
+
+        # The start of sequence is embedded at the blank index, see
+        # `Prediction.fuse_embedding`.
+        last_label = torch.full((B,), self._blank_id, dtype=torch.int64,
+                                device=device)
+        time_idx = torch.zeros(B, dtype=torch.int64, device=device)
+        symbols_added = torch.zeros(B, dtype=torch.int64, device=device)
+        output: List[List[int]] = [[] for _ in range(B)]
+
+        while True:
+            index = hyps.active()
+            if index.numel() == 0:
+                break
+
+            f = enc_proj[index, time_idx[index]].unsqueeze(1)
+            g, hidden = hyps.predict(self._model.prediction,
+                                     last_label[index].unsqueeze(1), index)
+            k = self._model.joint.joint_step(f, g)[:, 0, :].argmax(1)
+
+            not_blank = k != self._blank_id
+            hyps.update(index, hidden, not_blank)
+            emitted = index[not_blank]
+            labels = k[not_blank]
+            for b, label in zip(emitted.tolist(), labels.tolist()):
+                output[b].append(label)
+            last_label[emitted] = torch.where(labels > self._blank_id,
+                                              labels - 1, labels)
+
+            symbols_added[index] += 1
+            advance = index[~not_blank |
+                            (symbols_added[index] >= self._max_symbols_per_step)]
+            time_idx[advance] += 1
+            symbols_added[advance] = 0
+            hyps.remove(advance[time_idx[advance] >= out_lens[advance]])
+
+        return output
+
+
+class CudaGraphStep:
+    """A greedy decoding step captured as a CUDA graph.
+
+    One step is a single label through `Prediction.predict_step` followed by
+    `Joint.joint_step` for a single time step. Its shapes do not change during
+    decoding, so it is captured once and then replayed, removing the
+    per-kernel launch overhead that dominates these small steps.
+
+    Args:
+        model: Model to use for prediction, on a CUDA device.
+        f: Example encoder projection for a single time step, of shape
+            (B, 1, J), see `Joint.project_encoder`.
+        blank_index: Index of the blank label.
+    """
+
+    def __init__(self, model, f, blank_index, num_warmup=3):
+        self._model = model
+        self._f = torch.zeros_like(f)
+        self._label = torch.full((f.size(0), 1), blank_index,
+                                 dtype=torch.int64, device=f.device)
+        _, (h, c) = model.prediction.predict_step(self._label)
+        self._h = torch.zeros_like(h)
+        self._c = torch.zeros_like(c)
+
+        # Warm up on a side stream, as required before capture.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(num_warmup):
+                self._run()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._logits, self._hidden = self._run()
+
+    @staticmethod
+    def is_available() -> bool:
+        return hasattr(torch.cuda, "CUDAGraph")
+
+    def _run(self) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        g, hidden = self._model.prediction.predict_step(
+            self._label, (self._h, self._c))
+        logits = self._model.joint.joint_step(self._f, g)[:, 0, :]
+        return logits, hidden
+
+    def __call__(self, f: torch.Tensor, label: int,
+                 hidden: Optional[Tuple[torch.Tensor, torch.Tensor]]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        self._f.copy_(f)
+        self._label.fill_(label)
+        if hidden is None:
+            self._h.zero_()
+            self._c.zero_()
+        else:
+            self._h.copy_(hidden[0])
+            self._c.copy_(hidden[1])
+        self._graph.replay()
+        # The outputs are overwritten by the next replay, while the decoder
+        # may hold on to the hidden state across steps.
+        h, c = self._hidden
+        return self._logits.clone(), (h.clone(), c.clone())
+
+
+class HypBatch:
+    """Prediction network states of up to `max_batch` hypotheses.
+
+    The states are stored as a single (2, L, max_batch, H) tensor holding
+    h and c, rather than as an (h, c) tuple per hypothesis, so that the
+    active hypotheses can be gathered and advanced by a single
+    `Prediction.predict_step` call.
+
+    Args:
+        num_layers: Number of layers L of the prediction network.
+        hidden_size: Hidden size H of the prediction network.
+        max_batch: Maximum number of concurrent hypotheses.
+    """
+
+    def __init__(self, num_layers, hidden_size, max_batch,
+                 dtype=torch.float32, device=None):
+        self.states = torch.zeros((2, num_layers, max_batch, hidden_size),
+                                  dtype=dtype, device=device)
+        self.valid = torch.zeros(max_batch, dtype=torch.bool, device=device)
+
+    def add(self, index: int):
+        """Starts a new hypothesis with a zero state in slot `index`."""
+        self.states[:, :, index, :] = 0
+        self.valid[index] = True
+
+    def remove(self, index):
+        """Ends the hypotheses in slot `index`, an int or a tensor of slot
+        indexes."""
+        self.valid[index] = False
+
+    def active(self) -> torch.Tensor:
+        """Returns the slot indexes of the active hypotheses."""
+        return self.valid.nonzero().squeeze(1)
+
+    def predict(self, prediction, labels: torch.Tensor,
+                index: torch.Tensor) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """Runs one prediction step for the hypotheses in slots `index`.
+
+        The stored states are not changed, see `update`.
+
+        Args:
+            prediction: The prediction network.
+            labels: (N, 1) label per hypothesis, as for `predict_step`.
+            index: (N,) slot indexes.
+
+        Returns:
+            Tuple (g, hid) as returned by `predict_step`, for the N slots.
+        """
+        states = self.states.index_select(2, index)
+        return prediction.predict_step(labels, (states[0], states[1]))
+
+    def update(self, index: torch.Tensor,
+               hidden: Tuple[torch.Tensor, torch.Tensor],
+               mask: torch.Tensor):
+        """Stores the states `hidden` returned by `predict` for the slots
+        `index` where `mask` is set."""
+        index = index[mask]
+        self.states[0].index_copy_(1, index, hidden[0][:, mask])
+        self.states[1].index_copy_(1, index, hidden[1][:, mask])
+
+
+class CudaGraphEncoder:
+    """Runs the encoder by replaying CUDA graphs.
+
+    The input is zero-padded in time to a multiple of `pad_to` frames, and
+    one graph is captured per padded (T, B), so that a handful of graphs
+    cover all utterance lengths. The encoder is run with `mask_padding`, so
+    that the padding does not change the output.
+
+    Each graph keeps its own CUDA memory pool, so at most `max_graphs` are
+    kept, evicting the least recently used one.
+
+    Args:
+        encoder: The encoder, on a CUDA device.
+        pad_to: Multiple to pad the number of input frames to. Must be a
+            multiple of the encoder's stack time factor.
+        max_graphs: Maximum number of captured graphs to keep.
+    """
+
+    def __init__(self, encoder, pad_to=64, max_graphs=8, num_warmup=3):
+        self._encoder = encoder
+        self._pad_to = pad_to
+        self._max_graphs = max_graphs
+        self._num_warmup = num_warmup
+        self._graphs = OrderedDict()
+
+    def _capture(self, x: torch.Tensor):
+        B, T, _ = x.shape
+        x_lens = torch.full((B,), T, dtype=torch.int64, device=x.device)
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self._num_warmup):
+                self._encoder(x, x_lens, True)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            out, out_lens = self._encoder(x, x_lens, True)
+        return graph, x, x_lens, out, out_lens
+
+    def __call__(self, x: torch.Tensor, x_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        B, T, F = x.shape
+        T_padded = -(-T // self._pad_to) * self._pad_to
+        key = (T_padded, B)
+        if key in self._graphs:
+            self._graphs.move_to_end(key)
+        else:
+            if len(self._graphs) >= self._max_graphs:
+                self._graphs.popitem(last=False)
+            self._graphs[key] = self._capture(x.new_zeros((B, T_padded, F)))
+        graph, static_x, static_lens, out, out_lens = self._graphs[key]
+
+        static_x[:, T:, :].zero_()
+        static_x[:, :T, :].copy_(x)
+        static_lens.copy_(x_lens)
+        graph.replay()
+
+        out_lens = out_lens.clone()
+        return out[:, :int(out_lens.max().item()), :].clone(), out_lens
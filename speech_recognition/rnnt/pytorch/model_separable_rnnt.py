@@ -1,8 +1,10 @@
-from typing import Optional, Tuple
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
-import numpy as np
 import torch
 
+from rnn import lstm_cell
 from rnn import rnn
 from rnn import StackTime
 
@@ -18,6 +20,7 @@ class RNNT(torch.nn.Module):
             # configuration.
             in_features = feat_config['features'] * \
                 feat_config.get("frame_splicing", 1)
+        self.in_features = in_features
 
         self.encoder = Encoder(in_features,
             rnnt["encoder_n_hidden"],
@@ -30,6 +33,8 @@ class RNNT(torch.nn.Module):
             rnnt["dropout"],
         )
 
+        self.pred_rnn_layers = rnnt["pred_rnn_layers"]
+        self.pred_n_hidden = rnnt["pred_n_hidden"]
         self.prediction = Prediction(
             num_classes,
             rnnt["pred_n_hidden"],
@@ -47,10 +52,106 @@ class RNNT(torch.nn.Module):
             rnnt["joint_n_hidden"],
             rnnt["dropout"],
         )
+        self.joint_compiled = False
+        self.flatten_parameters()
 
     def forward(self, x_padded: torch.Tensor, x_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         return self.encoder(x_padded, x_lens)
-        
+
+    def flatten_parameters(self):
+        """Compacts the weights of every RNN into the contiguous layout
+        cuDNN expects, so that it is not rebuilt on every call."""
+        for module in self.modules():
+            if isinstance(module, torch.nn.RNNBase):
+                module.flatten_parameters()
+
+    def prepare_for_inference(self, dtype=torch.float32, quantize_joint=False,
+                              warmup_shape=None, compile_joint=False):
+        """Scripts and freezes the submodules for inference.
+
+        Must be called after the weights are loaded, since they become
+        constants. Returns the model itself.
+
+        Args:
+            dtype: Floating point type to run the encoder, prediction and
+                joint networks in, e.g. torch.float16 on GPUs. The output
+                layer of the joint network is always kept in float32, so
+                that the argmax over the logits stays stable. The encoder
+                then expects its input features in this type; the greedy
+                decoders cast them given the same `dtype`.
+            quantize_joint: Whether to apply dynamic int8 quantization to the
+                linear layers of the joint network, for inference on CPU.
+            warmup_shape: Optional (T, B) of an input to run the frozen
+                encoder on once, so that one-time initialization (e.g. CUDA
+                context and cuDNN handles, TorchScript's first profiling
+                runs) does not fall on the first real query. It does not
+                tune anything for other input shapes.
+            compile_joint: Whether to compile `Joint.joint_step` with
+                `torch.compile` instead of scripting the joint network. The
+                model can then no longer be scripted as a whole. Shapes are
+                static, which suits `ScriptGreedyDecoder`; with
+                `BatchedGreedyDecoder` every new number of active utterances
+                triggers a recompilation.
+        """
+        if quantize_joint and dtype != torch.float32:
+            raise ValueError("quantize_joint requires dtype=torch.float32")
+        if compile_joint and not hasattr(torch, "compile"):
+            raise ValueError("compile_joint requires torch.compile")
+        self.eval()
+        device = next(self.encoder.parameters()).device
+        if dtype != torch.float32:
+            self.encoder.to(dtype)
+            self.prediction.to(dtype)
+            self.joint.enc_proj.to(dtype)
+            self.joint.pred_proj.to(dtype)
+            self.joint.net = torch.nn.Sequential(_Float(), *self.joint.net)
+        self.flatten_parameters()
+        if quantize_joint:
+            torch.quantization.quantize_dynamic(
+                self.joint, {torch.nn.Linear}, dtype=torch.qint8,
+                inplace=True)
+        self.prediction.fuse_embedding()
+        self.encoder = _freeze(self.encoder)
+        self.prediction = _freeze(self.prediction, ["predict_step"])
+        if compile_joint:
+            # Decoding calls joint_step once per step with the same shapes,
+            # so static shapes let it be captured as a CUDA graph. The whole
+            # step is compiled, so that the sum of the projections, which
+            # the ReLU overwrites in place, stays internal to the graph.
+            self.joint.joint_step = torch.compile(
+                self.joint.joint_step, mode="reduce-overhead", dynamic=False)
+            self.joint_compiled = True
+        else:
+            self.joint = _freeze(self.joint, ["project_encoder", "joint_step"])
+
+        if warmup_shape is not None:
+            T, B = warmup_shape
+            with torch.no_grad():
+                self.encoder(
+                    torch.zeros((B, T, self.in_features), dtype=dtype,
+                                device=device),
+                    torch.full((B,), T, dtype=torch.int64, device=device))
+        return self
+
+
+class _Float(torch.nn.Module):
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return x.float()
+
+
+def _freeze(module, preserved_methods=None):
+    """Scripts and freezes `module`, keeping `preserved_methods` besides
+    forward, and applies `torch.jit.optimize_for_inference` if available.
+    """
+    preserved_methods = [] if preserved_methods is None else preserved_methods
+    module = torch.jit.script(module)
+    module = torch.jit._recursive.wrap_cpp_module(
+        torch._C._freeze_module(module._c, preserved_methods))
+    if hasattr(torch.jit, "optimize_for_inference"):
+        module = torch.jit.optimize_for_inference(
+            module, other_methods=preserved_methods)
+    return module
+
 
 class Encoder(torch.nn.Module):
     def __init__(self, in_features, encoder_n_hidden,
@@ -66,8 +167,10 @@ class Encoder(torch.nn.Module):
             norm=norm,
             forget_gate_bias=forget_gate_bias,
             dropout=dropout,
+            batch_first=True,
         )
-        self.stack_time = StackTime(factor=encoder_stack_time_factor)
+        self.stack_time = StackTime(factor=encoder_stack_time_factor,
+                                    batch_first=True)
         self.post_rnn = rnn(
             rnn=rnn_type,
             input_size=encoder_stack_time_factor * encoder_n_hidden,
@@ -77,15 +180,23 @@ class Encoder(torch.nn.Module):
             forget_gate_bias=forget_gate_bias,
             norm_first_rnn=True,
             dropout=dropout,
+            batch_first=True,
         )
 
-    def forward(self, x_padded: torch.Tensor, x_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x_padded: torch.Tensor, x_lens: torch.Tensor,
+                mask_padding: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        # (B, T, F)
         x_padded, _ = self.pre_rnn(x_padded, None)
+        if mask_padding:
+            # Zero the frames past the end of each sequence, so that
+            # StackTime stacks zeros onto the last frames of a padded
+            # sequence, as it does past the end of an unpadded one.
+            mask = torch.arange(x_padded.size(1), device=x_padded.device).unsqueeze(0) < \
+                x_lens.to(x_padded.device).unsqueeze(1)
+            x_padded = x_padded * mask.unsqueeze(2).type_as(x_padded)
         x_padded, x_lens = self.stack_time(x_padded, x_lens)
-        # (T, B, H)
         x_padded, _ = self.post_rnn(x_padded, None)
         # (B, T, H)
-        x_padded = x_padded.transpose(0, 1)
         return x_padded, x_lens
 
 class Prediction(torch.nn.Module):
@@ -94,6 +205,7 @@ class Prediction(torch.nn.Module):
         super().__init__()
         self.embed = torch.nn.Embedding(vocab_size - 1, n_hidden)
         self.n_hidden = n_hidden
+        self.pred_rnn_layers = pred_rnn_layers
         self.dec_rnn = rnn(
             rnn=rnn_type,
             input_size=n_hidden,
@@ -102,7 +214,23 @@ class Prediction(torch.nn.Module):
             norm=norm,
             forget_gate_bias=forget_gate_bias,
             dropout=dropout,
+            batch_first=True,
         )
+        # Inference-only tables used by `predict_step`, filled in by
+        # `fuse_embedding`. These are plain attributes rather than buffers,
+        # so that they are not part of the state dict.
+        self.embed_ih = torch.empty(0)
+        self.rnn_weight_ih = torch.empty(0)
+        self.rnn_weight_hh = torch.empty(0)
+        self.rnn_bias = torch.empty(0)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # `_apply` only converts parameters and buffers, so the fused
+        # tables are rebuilt from the converted weights instead.
+        if self.embed_ih.numel() > 0:
+            self.fuse_embedding()
+        return self
 
     def forward(self, y: Optional[torch.Tensor],
                 state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
@@ -113,7 +241,8 @@ class Prediction(torch.nn.Module):
         L - Number of decoder layers = 2
 
         Args:
-            y: (B, U)
+            y: (B, U), or None for the start of the sequence, in which case B
+                is taken from `state`, or is 1 if `state` is None.
 
         Returns:
             Tuple (g, hid) where:
@@ -124,12 +253,11 @@ class Prediction(torch.nn.Module):
                         c (tensor), shape (L, B, H)
         """
         if y is None:
-            # This is gross. I should really just pass in an SOS token
-            # instead. Is there no SOS token?
-            assert state is None
-            # Hacky, no way to determine this right now!
-            B = 1
-            y = torch.zeros((B, 1, self.n_hidden), dtype=torch.float32)
+            # The start of sequence is embedded as zeros, on the device and
+            # in the precision of the embedding.
+            B = 1 if state is None else state[0].size(1)
+            y = self.embed.weight.new_zeros((1, 1, self.n_hidden))
+            y = y.expand(B, 1, self.n_hidden)
         else:
             y = self.embed(y)
 
@@ -141,19 +269,106 @@ class Prediction(torch.nn.Module):
         #        for _ in range(self.pred_rnn_layers)
         #    ]
 
-        y = y.transpose(0, 1)  # .contiguous()   # (U + 1, B, H)
-        g, hid = self.dec_rnn(y, state)
-        g = g.transpose(0, 1)  # .contiguous()   # (B, U + 1, H)
+        g, hid = self.dec_rnn(y, state)   # (B, U + 1, H)
         # del y, state
         return g, hid
 
+    def fuse_embedding(self):
+        """Precomputes the tables used by `predict_step`.
+
+        The embedding lookup followed by the input projection of the first
+        LSTM layer is folded into a single lookup in
+        `embed.weight @ weight_ih_l0.T`. An extra zero row is appended at
+        index `embed.num_embeddings` for the start of sequence, so that it
+        can be looked up like any other label.
+
+        The tables are snapshots of the weights: they follow `.to()`,
+        `.half()` and the like, but must be rebuilt by calling this again
+        whenever the weights themselves change, e.g. after
+        `load_state_dict`. Only `predict_step` uses them, never `forward`.
+        """
+        lstm = self.dec_rnn.lstm
+        with torch.no_grad():
+            weight_ih = [getattr(lstm, f"weight_ih_l{i}")
+                         for i in range(self.pred_rnn_layers)]
+            weight_hh = [getattr(lstm, f"weight_hh_l{i}")
+                         for i in range(self.pred_rnn_layers)]
+            bias = [getattr(lstm, f"bias_ih_l{i}") +
+                    getattr(lstm, f"bias_hh_l{i}")
+                    for i in range(self.pred_rnn_layers)]
+            embed_ih = self.embed.weight.mm(weight_ih[0].t())
+            self.embed_ih = torch.cat([embed_ih, embed_ih.new_zeros((1, embed_ih.size(1)))])
+            self.rnn_weight_ih = torch.stack(weight_ih)
+            self.rnn_weight_hh = torch.stack(weight_hh)
+            self.rnn_bias = torch.stack(bias)
+
+    @torch.jit.export
+    def predict_step(self, y: Optional[torch.Tensor],
+                     state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """Inference-only equivalent of `forward` for a single label.
+
+        Requires `fuse_embedding` to have been called.
+
+        Args:
+            y: (B, 1), or None for the start of the sequence.
+
+        Returns:
+            Tuple (g, hid) where g is (B, 1, H) and hid is as in `forward`.
+        """
+        assert self.embed_ih.numel() > 0, "fuse_embedding() was not called"
+        if y is None:
+            # The start of sequence is embedded as zeros, so only the bias
+            # contributes to the first layer's input projection.
+            B = 1 if state is None else state[0].size(1)
+            gates = self.rnn_bias[0].expand(B, -1)
+        else:
+            B = y.size(0)
+            gates = self.embed_ih.index_select(0, y.view(-1)) + self.rnn_bias[0]
+
+        if state is None:
+            h = torch.zeros((self.pred_rnn_layers, B, self.n_hidden),
+                            dtype=gates.dtype, device=gates.device)
+            c = torch.zeros_like(h)
+        else:
+            h, c = state
+
+        hs: List[torch.Tensor] = []
+        cs: List[torch.Tensor] = []
+        for layer in range(self.pred_rnn_layers):
+            if layer > 0:
+                gates = torch.addmm(self.rnn_bias[layer], hs[-1],
+                                    self.rnn_weight_ih[layer].t())
+            gates = torch.addmm(gates, h[layer],
+                                self.rnn_weight_hh[layer].t())
+            h_l, c_l = lstm_cell(gates, c[layer])
+            hs.append(h_l)
+            cs.append(c_l)
+
+        g = hs[-1].unsqueeze(1)   # (B, 1, H)
+        return g, (torch.stack(hs), torch.stack(cs))
+
 class Joint(torch.nn.Module):
     def __init__(self, vocab_size, pred_n_hidden, enc_n_hidden,
                  joint_n_hidden, dropout):
         super().__init__()
+        # The first layer of the joint network is applied to the
+        # concatenation [f, g]. It is split column-wise into two
+        # projections, so that f and g are projected separately and then
+        # broadcast-added: W [f; g] + b == W_f f + W_g g + b.
+        joint_input = torch.nn.Linear(pred_n_hidden + enc_n_hidden,
+                                      joint_n_hidden)
+        self.enc_proj = torch.nn.Linear(enc_n_hidden, joint_n_hidden)
+        self.pred_proj = torch.nn.Linear(pred_n_hidden, joint_n_hidden,
+                                         bias=False)
+        with torch.no_grad():
+            self.enc_proj.weight.copy_(joint_input.weight[:, :enc_n_hidden])
+            self.enc_proj.bias.copy_(joint_input.bias)
+            self.pred_proj.weight.copy_(joint_input.weight[:, enc_n_hidden:])
+
+        # The input to the ReLU is always the freshly broadcast sum of the
+        # two projections, so it can be applied in place.
         layers = [
-            torch.nn.Linear(pred_n_hidden + enc_n_hidden, joint_n_hidden),
-            torch.nn.ReLU(),
+            torch.nn.ReLU(inplace=True),
         ] + ([torch.nn.Dropout(p=dropout), ] if dropout else []) + [
             torch.nn.Linear(joint_n_hidden, vocab_size)
         ]
@@ -169,28 +384,74 @@ class Joint(torch.nn.Module):
         returns:
             logits of shape (B, T, U, K + 1)
         """
-        # Combine the input states and the output states
-        B, T, H = f.shape
-        B, U_, H2 = g.shape
+        # Project the input states and the output states separately and
+        # combine them by broadcasting, instead of materializing the
+        # (B, T, U, 2H) concatenation.
+        f = self.enc_proj(f).unsqueeze(dim=2)    # (B, T, 1, J)
+        g = self.pred_proj(g).unsqueeze(dim=1)   # (B, 1, U + 1, J)
 
-        f = f.unsqueeze(dim=2)   # (B, T, 1, H)
-        f = f.expand((B, T, U_, H))
+        res = self.net(f + g)   # (B, T, U + 1, K + 1)
+        return res
 
-        g = g.unsqueeze(dim=1)   # (B, 1, U + 1, H)
-        g = g.expand((B, T, U_, H2))
+    @torch.jit.export
+    def project_encoder(self, f: torch.Tensor) -> torch.Tensor:
+        """
+        f should be shape (B, T, H)
+
+        returns:
+            the encoder projection of shape (B, T, J), which does not depend
+            on the labels and so can be computed once per utterance.
+        """
+        return self.enc_proj(f)
+
+    @torch.jit.export
+    def joint_step(self, f_proj: torch.Tensor, g: torch.Tensor) -> torch.Tensor:
+        """
+        f_proj should be shape (B, 1, J), one time step of `project_encoder`
+        g should be shape (B, U + 1, H)
+
+        returns:
+            logits of shape (B, U + 1, K + 1)
+        """
+        return self.net(f_proj + self.pred_proj(g))
+
+_label_buffers = threading.local()
+_LABEL_BUFFERS_SIZE = 4
+
+
+def _label_buffer(batch_size, max_len, pin_memory):
+    """Returns an uninitialized int64 buffer from a small per-thread LRU
+    pool, keyed by shape and pinning."""
+    pool = getattr(_label_buffers, "pool", None)
+    if pool is None:
+        pool = _label_buffers.pool = OrderedDict()
+    key = (batch_size, max_len, pin_memory)
+    buf = pool.pop(key, None)
+    if buf is None:
+        buf = torch.empty((batch_size, max_len), dtype=torch.int64,
+                          pin_memory=pin_memory)
+        if len(pool) >= _LABEL_BUFFERS_SIZE:
+            pool.popitem(last=False)
+    pool[key] = buf
+    return buf
 
-        inp = torch.cat([f, g], dim=3)   # (B, T, U, 2H)
-        res = self.net(inp)
-        # del f, g, inp
-        return res
 
-def label_collate(labels):
+def label_collate(labels, pin_memory=False, reuse_buffer=False):
     """Collates the label inputs for the rnn-t prediction network.
 
     If `labels` is already in torch.Tensor form this is a no-op.
 
     Args:
         labels: A torch.Tensor List of label indexes or a torch.Tensor.
+        pin_memory: Whether to return the collated labels in pinned memory,
+            for asynchronous copies to the GPU.
+        reuse_buffer: Whether to collate into a buffer reused across calls
+            with the same shape, avoiding an allocation per call. The
+            result is then overwritten by the next such call, without any
+            synchronization: if it was copied to the GPU with
+            `non_blocking=True`, the caller must make sure that copy has
+            completed (e.g. by synchronizing its stream or an event recorded
+            after it) before calling again with the same shape.
 
     Returns:
         A padded torch.Tensor of shape (batch, max_seq_len).
@@ -203,12 +464,18 @@ def label_collate(labels):
             f"`labels` should be a list or tensor not {type(labels)}"
         )
 
-    batch_size = len(labels)
-    max_len = max(len(l) for l in labels)
+    if reuse_buffer:
+        max_len = max(len(l) for l in labels)
+        cat_labels = _label_buffer(len(labels), max_len, pin_memory)
+        for e, l in enumerate(labels):
+            cat_labels[e, :len(l)] = torch.as_tensor(l, dtype=torch.int64)
+            cat_labels[e, len(l):] = 0
+        return cat_labels
 
-    cat_labels = np.full((batch_size, max_len), fill_value=0.0, dtype=np.int32)
-    for e, l in enumerate(labels):
-        cat_labels[e, :len(l)] = l
-    labels = torch.LongTensor(cat_labels)
+    cat_labels = torch.nn.utils.rnn.pad_sequence(
+        [torch.as_tensor(l, dtype=torch.int64) for l in labels],
+        batch_first=True, padding_value=0)
+    if pin_memory:
+        cat_labels = cat_labels.pin_memory()
 
-    return labels
+    return cat_labels
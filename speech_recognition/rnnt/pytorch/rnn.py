@@ -40,7 +40,7 @@ def rnn(rnn, input_size, hidden_size, num_layers, norm=None,
 class LstmDrop(torch.nn.Module):
 
     def __init__(self, input_size, hidden_size, num_layers, dropout, forget_gate_bias,
-                 **kwargs):
+                 batch_first=False, **kwargs):
         """Returns an LSTM with forget gate bias init to `forget_gate_bias`.
 
         Args:
@@ -50,6 +50,7 @@ class LstmDrop(torch.nn.Module):
             dropout: See `torch.nn.LSTM`.
             forget_gate_bias: For each layer and each direction, the total value of
                 to initialise the forget gate bias to.
+            batch_first: See `torch.nn.LSTM`.
 
         Returns:
             A `torch.nn.LSTM`.
@@ -61,6 +62,7 @@ class LstmDrop(torch.nn.Module):
             hidden_size=hidden_size,
             num_layers=num_layers,
             dropout=dropout,
+            batch_first=batch_first,
         )
         if forget_gate_bias is not None:
             for name, v in self.lstm.named_parameters():
@@ -88,20 +90,49 @@ class LstmDrop(torch.nn.Module):
 
 class StackTime(torch.nn.Module):
 
-    __constants__ = ["factor"]
+    __constants__ = ["factor", "batch_first"]
 
-    def __init__(self, factor):
+    def __init__(self, factor, batch_first=False):
         super().__init__()
         self.factor = int(factor)
+        self.batch_first = batch_first
 
     def forward(self, x, x_lens):
-        # T, B, U
+        # T, B, U, or B, T, U if batch_first
+        time_dim = 1 if self.batch_first else 0
+        T = x.size(time_dim)
         seq = [x]
         for i in range(1, self.factor):
             # This doesn't seem to make much sense...
             tmp = torch.zeros_like(x)
-            tmp[:-i, :, :] = x[i:, :, :]
+            n = max(T - i, 0)
+            tmp.narrow(time_dim, 0, n).copy_(x.narrow(time_dim, i, n))
             seq.append(tmp)
         x_lens = torch.ceil(x_lens.float() / self.factor).int()
         # Gross, this is horrible. What a waste of memory...
-        return torch.cat(seq, dim=2)[::self.factor, :, :], x_lens
+        x = torch.cat(seq, dim=2)
+        if self.batch_first:
+            return x[:, ::self.factor, :], x_lens
+        return x[::self.factor, :, :], x_lens
+
+@torch.jit.script
+def lstm_cell(gates: torch.Tensor, c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Applies the pointwise part of a `torch.nn.LSTM` cell.
+
+    Args:
+        gates: Pre-activation gates of shape (B, 4H), i.e. the sum of the
+            input and hidden projections including both biases, in the
+            (input, forget, cell, output) order used by `torch.nn.LSTM`.
+        c: Previous cell state of shape (B, H).
+
+    Returns:
+        Tuple (h, c) of the next hidden and cell states, each (B, H).
+    """
+    i, f, g, o = gates.chunk(4, 1)
+    i = torch.sigmoid(i)
+    f = torch.sigmoid(f)
+    g = torch.tanh(g)
+    o = torch.sigmoid(o)
+    c = f * c + i * g
+    h = o * torch.tanh(c)
+    return h, c
@@ -30,7 +30,7 @@ from preprocessing import AudioPreprocessing
 from model_separable_rnnt import RNNT
 
 
-def load_and_migrate_checkpoint(ckpt_path):
+def load_and_migrate_checkpoint(ckpt_path, enc_n_hidden):
     checkpoint = torch.load(ckpt_path, map_location="cpu")
     migrated_state_dict = {}
     for key, value in checkpoint['state_dict'].items():
@@ -38,6 +38,17 @@ def load_and_migrate_checkpoint(ckpt_path):
         migrated_state_dict[key] = value
     del migrated_state_dict["audio_preprocessor.featurizer.fb"]
     del migrated_state_dict["audio_preprocessor.featurizer.window"]
+
+    # The first joint layer is split into separate encoder and prediction
+    # projections (see Joint), so the remaining layers shift down by one.
+    joint_weight = migrated_state_dict.pop("joint.net.0.weight")
+    migrated_state_dict["joint.enc_proj.weight"] = joint_weight[:, :enc_n_hidden]
+    migrated_state_dict["joint.enc_proj.bias"] = migrated_state_dict.pop("joint.net.0.bias")
+    migrated_state_dict["joint.pred_proj.weight"] = joint_weight[:, enc_n_hidden:]
+    for key in [k for k in migrated_state_dict if k.startswith("joint.net.")]:
+        _, _, index, name = key.split(".", 3)
+        migrated_state_dict[f"joint.net.{int(index) - 1}.{name}"] = \
+            migrated_state_dict.pop(key)
     return migrated_state_dict
 
 
@@ -68,18 +79,11 @@ class PytorchSUT:
             rnnt=config['rnnt'],
             num_classes=len(rnnt_vocab)
         )
-        model.load_state_dict(load_and_migrate_checkpoint(checkpoint_path),
-                              strict=True)
-        model.eval()
-        model.encoder = torch.jit.script(model.encoder)
-        model.encoder = torch.jit._recursive.wrap_cpp_module(
-            torch._C._freeze_module(model.encoder._c))
-        model.prediction = torch.jit.script(model.prediction)
-        model.prediction = torch.jit._recursive.wrap_cpp_module(
-            torch._C._freeze_module(model.prediction._c))
-        model.joint = torch.jit.script(model.joint)
-        model.joint = torch.jit._recursive.wrap_cpp_module(
-            torch._C._freeze_module(model.joint._c))
+        model.load_state_dict(
+            load_and_migrate_checkpoint(checkpoint_path,
+                                        config['rnnt']['encoder_n_hidden']),
+            strict=True)
+        model.prepare_for_inference()
         model = torch.jit.script(model)
 
         self.greedy_decoder = ScriptGreedyDecoder(len(rnnt_vocab) - 1, model)
@@ -97,7 +101,7 @@ class PytorchSUT:
                 feature, feature_length = self.audio_preprocessor.forward((waveform, waveform_length))
                 assert feature.ndim == 3
                 assert feature_length.ndim == 1
-                feature = feature.permute(2, 0, 1)
+                feature = feature.permute(0, 2, 1)
 
                 _, _, transcript = self.greedy_decoder.forward(feature, feature_length)
 